@@ -1,9 +1,410 @@
 import os
 import glob
+import atexit
+import traceback
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from astropy.io import fits
 import numpy as np
 import sys
 
+try:
+    import bottleneck as bn
+except ImportError:
+    bn = None
+
+try:
+    from numba import njit, prange, set_num_threads
+except ImportError:
+    njit = None
+
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
+
+def read_header(path):
+    """Reads the primary header of the FITS file at path.
+
+    Uses fitsio's cfitsio-backed parser when it is installed, which is
+    much faster than astropy when looping over thousands of small files,
+    and falls back to astropy otherwise. Headers read here are only used
+    for keyword lookups; headers that are written back out are always
+    read with astropy.
+
+    Parameters
+    ----------
+    path : str
+        Path of a FITS file.
+
+    Returns
+    -------
+    fitsio.FITSHDR or astropy.io.fits.Header
+        Primary header.
+    """
+    if fitsio is not None:
+        return fitsio.read_header(path, ext=0)
+    return fits.getheader(path, ignore_missing_end=True)
+
+
+def read_data(path):
+    """Reads the primary image data of the FITS file at path.
+
+    Uses fitsio when it is installed and falls back to astropy
+    otherwise. The astropy path relies on astropy's default memory
+    mapping, which maps the file when it can and silently reads scaled
+    integer data (BZERO/BSCALE, this camera's native uint16 format) into
+    memory instead — requesting memmap explicitly would raise on such
+    files. The pixels are cast straight into a float32 array and the
+    data reference is dropped so any map is released before returning.
+
+    Parameters
+    ----------
+    path : str
+        Path of a FITS file.
+
+    Returns
+    -------
+    numpy.ndarray
+        Primary image data as float32.
+    """
+    if fitsio is not None:
+        return fitsio.read(path, ext=0).astype(np.float32, copy=False)
+    with fits.open(path, lazy_load_hdus=True) as hdulist:
+        try:
+            return np.asarray(hdulist[0].data, dtype=np.float32)
+        finally:
+            del hdulist[0].data
+
+
+def stack_median(stack, axis=-1):
+    """Takes the median of a stack of frames along the given axis.
+
+    Uses Bottleneck's partition-based median when it is installed, which
+    is considerably faster than np.median on large float32 stacks.
+    Otherwise selects the middle sample directly with np.partition's
+    introselect, which only has to place the middle of each pixel's
+    series rather than fully sort it the way np.median does.
+
+    Parameters
+    ----------
+    stack : numpy.ndarray
+        Array of image frames.
+    axis : int
+        Axis along which the median is taken.
+
+    Returns
+    -------
+    numpy.ndarray
+        Median image.
+    """
+    if bn is not None:
+        return bn.median(stack, axis=axis)
+
+    n = stack.shape[axis]
+    k = n // 2
+    index = [slice(None)]*stack.ndim
+    if n % 2:
+        part = np.partition(stack, k, axis=axis)
+        index[axis] = k
+        return part[tuple(index)]
+    part = np.partition(stack, (k - 1, k), axis=axis)
+    index[axis] = slice(k - 1, k + 1)
+    return part[tuple(index)].mean(axis=axis)
+
+
+def isr_kernel(image, mbias, mdark, mflat, out):
+    """Removes instrument signatures from one image in a single pass.
+
+    Computes out = (image - mbias - mdark) / mflat, where mdark has
+    already been scaled by the light frame's exposure time. When Numba is
+    installed the kernel is compiled so each pixel is loaded and stored
+    exactly once across all cores; otherwise it falls back to in-place
+    NumPy operations. It is safe to pass the same array as image and out.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+        Raw light frame data.
+    mbias : numpy.ndarray
+        Master bias.
+    mdark : numpy.ndarray
+        Master dark scaled by the light frame exposure time.
+    mflat : numpy.ndarray
+        Master flat.
+    out : numpy.ndarray
+        Array that the calibrated image is written into.
+
+    Returns
+    -------
+    out : numpy.ndarray
+        Instrument-signature-removed image.
+    """
+    if _isr_kernel_numba is not None:
+        _isr_kernel_numba(image, mbias, mdark, mflat, out)
+    else:
+        np.subtract(image, mbias, out=out)
+        out -= mdark
+        out /= mflat
+    return out
+
+
+_isr_kernel_numba = None
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _isr_kernel_numba(image, mbias, mdark, mflat, out):
+        for i in prange(image.shape[0]):
+            for j in range(image.shape[1]):
+                out[i, j] = (image[i, j] - mbias[i, j]
+                             - mdark[i, j]) / mflat[i, j]
+
+
+# Per-process cache of master calibration arrays so each worker in the
+# ISR process pool reads them from mcalib once instead of receiving them
+# pickled with every task.
+_calib_cache = {}
+
+# Per-process scratch image reused by _isr_one_image so each light frame
+# does not allocate a fresh full-size float32 array.
+_work_buffer = None
+
+
+def _get_work_buffer(shape):
+    """Returns the per-process scratch image, allocating it on first use.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the light frame being calibrated.
+
+    Returns
+    -------
+    numpy.ndarray
+        Reusable float32 array of the given shape.
+    """
+    global _work_buffer
+    if _work_buffer is None or _work_buffer.shape != shape:
+        _work_buffer = np.empty(shape, dtype=np.float32)
+    return _work_buffer
+
+
+def _load_calib(path):
+    """Returns the master calibration array at path, cached per process.
+
+    Parameters
+    ----------
+    path : str
+        Path of a master calibration FITS file in mcalib.
+
+    Returns
+    -------
+    numpy.ndarray
+        Calibration image data.
+    """
+    array = _calib_cache.get(path)
+    if array is None:
+        array = read_data(path)
+        _calib_cache[path] = array
+    return array
+
+
+def _load_scaled_dark(path, exptime):
+    """Returns the master dark at path scaled by exptime, cached per process.
+
+    Parameters
+    ----------
+    path : str
+        Path of the master dark FITS file in mcalib.
+    exptime : float
+        Exposure time of the light frames being calibrated.
+
+    Returns
+    -------
+    numpy.ndarray
+        Master dark scaled to the light frame exposure time.
+    """
+    array = _calib_cache.get((path, exptime))
+    if array is None:
+        array = _load_calib(path)*exptime
+        _calib_cache[(path, exptime)] = array
+    return array
+
+
+# Per-process writer pool and its last pending write, so writing frame n
+# to disk overlaps reading and calibrating frame n+1. Writer threads are
+# joined at interpreter exit, so every write completes before the worker
+# processes shut down.
+_io_pool = None
+_pending_write = None
+
+# Name of the file in ISR_Images where a worker records a failure in its
+# final background write, and the path the current worker writes it to.
+# instrument_signature_removal checks for the file after the pool shuts
+# down, since the pool reports those frames' tasks as done.
+WRITE_ERROR_LOG = 'write-errors.log'
+_write_error_log = None
+
+
+def _drain_pending_write():
+    """Resolves the worker's last queued write at process exit.
+
+    Registered with atexit when the writer pool is created. Every other
+    write is checked by the next task's _submit_write, but the final one
+    would otherwise only be resolved by the writer-thread join, which
+    discards its exception. A failure is appended to the error log for
+    the parent to find and the worker exits nonzero.
+
+    Returns
+    -------
+    None
+    """
+    if _pending_write is not None:
+        try:
+            _pending_write.result()
+        except Exception:
+            with open(_write_error_log, 'a') as log:
+                log.write(traceback.format_exc())
+            os._exit(1)
+
+
+# Structural keywords that cfitsio writes itself and that must not be
+# copied over from the light frame header.
+_STRUCTURAL_KEYWORDS = ('SIMPLE', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2',
+                        'EXTEND', 'BSCALE', 'BZERO', '')
+
+
+def _write_fits(out_path, image, prihdr):
+    """Writes one calibrated image to out_path with its header.
+
+    Uses fitsio when it is installed so the header cards are serialized
+    by cfitsio in C rather than astropy's pure-Python card writer, and
+    falls back to astropy otherwise. A failed write is reported on
+    stderr here before re-raising: a worker's last queued write is only
+    resolved when its writer thread is joined at process exit, where the
+    stored exception would otherwise be discarded silently.
+
+    Parameters
+    ----------
+    out_path : str
+        Path of the FITS file to write.
+    image : numpy.ndarray
+        Calibrated image data.
+    prihdr : astropy.io.fits.Header
+        Header of the light frame the image came from.
+
+    Returns
+    -------
+    None
+    """
+    try:
+        if fitsio is not None:
+            records = [{'name': card.keyword, 'value': card.value,
+                        'comment': card.comment} for card in prihdr.cards
+                       if card.keyword not in _STRUCTURAL_KEYWORDS]
+            fitsio.write(out_path, image, header=records, clobber=True)
+        else:
+            hdu = fits.PrimaryHDU(image, header=prihdr)
+            fits.HDUList([hdu]).writeto(out_path, overwrite=True)
+    except Exception:
+        print('\nFailed to write {}:'.format(out_path), file=sys.stderr)
+        traceback.print_exc()
+        raise
+
+
+def _submit_write(out_path, image, prihdr):
+    """Queues one calibrated image to be written in the background.
+
+    Waits for the previous write first, which surfaces any write error
+    and bounds the number of frames buffered in memory to one.
+
+    Parameters
+    ----------
+    out_path : str
+        Path of the FITS file to write.
+    image : numpy.ndarray
+        Calibrated image data, owned by the writer from here on.
+    prihdr : astropy.io.fits.Header
+        Header of the light frame the image came from.
+
+    Returns
+    -------
+    None
+    """
+    global _io_pool, _pending_write, _write_error_log
+    if _io_pool is None:
+        _io_pool = ThreadPoolExecutor(max_workers=2)
+        atexit.register(_drain_pending_write)
+    if _pending_write is not None:
+        _pending_write.result()
+    _write_error_log = os.path.join(os.path.dirname(os.path.dirname(out_path)),
+                                    WRITE_ERROR_LOG)
+    _pending_write = _io_pool.submit(_write_fits, out_path, image, prihdr)
+
+
+def _limit_worker_threads():
+    """Keeps ISR pool workers from oversubscribing the CPU.
+
+    Initializer for the process pool in instrument_signature_removal.
+    The pool already runs one worker per core, so the Numba-compiled
+    kernel is capped at one thread per process; without the cap every
+    worker would spin up its own thread per core.
+
+    Returns
+    -------
+    None
+    """
+    if njit is not None:
+        set_num_threads(1)
+
+
+def _isr_one_image(args):
+    """Removes instrument signatures from a single light frame.
+
+    Worker for the process pool in instrument_signature_removal. Reads
+    one light frame, applies isr_kernel with the cached master
+    calibration images, and writes the result to its output path.
+
+    Parameters
+    ----------
+    args : tuple
+        (o_file, out_path, mbias_path, mdark_path, mflat_path, exptime,
+        saturation) task descriptor.
+
+    Returns
+    -------
+    str
+        Base name of the light frame that was processed.
+    """
+    (o_file, out_path, mbias_path, mdark_path, mflat_path, exptime,
+     saturation) = args
+
+    mbias_array = _load_calib(mbias_path)
+    mdark_scaled = _load_scaled_dark(mdark_path, exptime)
+    mflat_array = _load_calib(mflat_path)
+
+    # The light frame is copied straight into the scratch buffer, then
+    # any memory map is released. Astropy's default open is used because
+    # explicit memmap raises on scaled integer (BZERO/BSCALE) data.
+    work = _get_work_buffer(mbias_array.shape)
+    with fits.open(o_file, lazy_load_hdus=True) as hdulist:
+        try:
+            # Adds saturation to header.
+            hdulist[0].header['SATLEVEL'] = saturation
+            prihdr = hdulist[0].header
+            np.copyto(work, hdulist[0].data)
+        finally:
+            del hdulist[0].data
+
+    # Removes instrument signatures.
+    isr_kernel(work, mbias_array, mdark_scaled, mflat_array, work)
+
+    # Writes ISR file in the background while the next frame is read.
+    # The scratch buffer is reused, so the writer gets its own copy.
+    _submit_write(out_path, work.copy(), prihdr)
+
+    return os.path.basename(o_file)
+
 
 def ISR_main(dirtarget, dirdark, target):
     """Creates ISR FITS files by executing a preliminary calibration sequence.
@@ -68,62 +469,69 @@ def get_unfiltered_calibimages(dirtarget, dirdark):
         print('\nNo dark calibration files found. Ensure that they are saved in your dark directory and try again.')
         sys.exit()
 
-    try:
-        os.mkdir(dirtarget + '/mcalib')
-        os.mkdir(dirtarget + '/ISR_Images')
-    except FileExistsError:
-        pass
-
-    biases = []
-    bias_prihdr = None
-    darks = []
-    dark_prihdr = None
+    os.makedirs(os.path.join(dirtarget, 'mcalib'), exist_ok=True)
+    os.makedirs(os.path.join(dirtarget, 'ISR_Images'), exist_ok=True)
+
+    bias_paths = []
+    dark_paths = []
     dark_exptime = None
-    bias = False
-    dark = False
 
-    # Retrieves all bias frames and creates master bias.
+    # Finds all bias frames by header so the stack can be preallocated.
     for o_file in t_files:
-        hdulist = fits.open(o_file)
-        if hdulist[0].header['IMAGETYP'] == 'Bias Frame':
-            bias = True
-            biases.append(fits.getdata(o_file))
-            bias_prihdr = hdulist[0].header
-        hdulist.close()
-
-    if not bias:
+        hdr = read_header(o_file)
+        if hdr['IMAGETYP'] == 'Bias Frame':
+            bias_paths.append(o_file)
+
+    if len(bias_paths) == 0:
         print('\nBias frame calibration file not found. Ensure that they are in your target directory and try again.')
         sys.exit()
 
-    bias_array = np.array(biases, dtype=float)
+    # Reads the header that the master bias is saved with.
+    bias_prihdr = fits.getheader(bias_paths[-1])
 
-    mbias_array = np.median(bias_array, 0)
+    # Get image dimensions from the header
+    x_dim = int(bias_prihdr['NAXIS1'])
+    y_dim = int(bias_prihdr['NAXIS2'])
+
+    # Streams each bias frame into the stack and creates master bias. The
+    # stack is laid out as a per-pixel series, (y, x, n), so the median
+    # reduces along contiguous memory.
+    bias_array = np.empty((y_dim, x_dim, len(bias_paths)), dtype=np.float32)
+    for n, o_file in enumerate(bias_paths):
+        bias_array[..., n] = read_data(o_file)
+
+    mbias_array = stack_median(bias_array)
 
     # Saves master bias to mcalib.
     hdu = fits.PrimaryHDU(mbias_array, header=bias_prihdr)
     hdulist = fits.HDUList([hdu])
     hdulist.writeto(dirtarget + '/mcalib/mbias.fits', overwrite=True)
 
-    # Retrieves all dark frames from dirdark as well as .
+    # Finds all dark frames in dirdark by header.
     for o_file in d_files:
-        hdulist = fits.open(o_file)
-        if hdulist[0].header['IMAGETYP'] == 'Dark Frame':
-            darks.append(fits.getdata(o_file))
-            dark_exptime = hdulist[0].header['EXPTIME']
-            dark_prihdr = hdulist[0].header
-            dark = True
-
-    if not dark:
+        hdr = read_header(o_file)
+        if hdr['IMAGETYP'] == 'Dark Frame':
+            dark_paths.append(o_file)
+            dark_exptime = hdr['EXPTIME']
+
+    if len(dark_paths) == 0:
         print('\nDark frame calibration files not found. Ensure that they are in your target directory or that their location was entered correctly in the input file and try again.')
         sys.exit()
 
-    dark_array = np.array(darks, dtype=float)
+    # Reads the header that the master dark is saved with.
+    dark_prihdr = fits.getheader(dark_paths[-1])
 
-    for dark in dark_array:
-        dark -= mbias_array
-        dark /= dark_exptime
+    # Streams each dark frame into the stack.
+    dark_array = np.empty((y_dim, x_dim, len(dark_paths)), dtype=np.float32)
+    for n, o_file in enumerate(dark_paths):
+        dark_array[..., n] = read_data(o_file)
 
-    mdark = np.median(dark_array, 0)
+    # Removes bias from and time-corrects every dark in one fused pass
+    # over the stack, writing back into the stack to avoid a temporary.
+    np.subtract(dark_array, mbias_array[..., np.newaxis], out=dark_array)
+    dark_array *= np.float32(1.0 / dark_exptime)
+
+    mdark = stack_median(dark_array)
 
     # Saves master dark.
     hdu = fits.PrimaryHDU(mdark, header=dark_prihdr)
@@ -158,61 +566,59 @@ def get_filtered_calibimages(dirtarget):
     files = sorted(glob.glob(os.path.join(dirtarget, '*.fit')))
     calib_files = glob.glob(os.path.join(dirtarget + '/mcalib/', '*.fits'))
 
-    # Open an image file
-    image_file = fits.open(files[0])
-    # Get image dimensions from the header
-    x_dim = int(image_file[0].header['NAXIS1'])
-    y_dim = int(image_file[0].header['NAXIS2'])
-    # Close image file
-    image_file.close()
+    # Get image dimensions from the header of an image file.
+    hdr = read_header(files[0])
+    x_dim = int(hdr['NAXIS1'])
+    y_dim = int(hdr['NAXIS2'])
 
     # Retrieve master bias.
     for o_file in calib_files:
-        hdulist = fits.open(o_file)
-        if hdulist[0].header['IMAGETYP'] == 'Bias Frame':
-            mbias.append(fits.getdata(o_file))
-        hdulist.close()
+        if read_header(o_file)['IMAGETYP'] == 'Bias Frame':
+            mbias.append(read_data(o_file))
 
-    mbias_array = np.array(mbias, dtype=float)
+    mbias_array = np.array(mbias, dtype=np.float32)
 
-    # Retrieve all filter types used on dataset.
+    # Retrieve all filter types used on dataset and sort flat field paths
+    # by filter. Only the headers are needed here, so skip loading the
+    # image data entirely.
+    flat_paths = defaultdict(list)
     for o_file in files:
-        hdulist = fits.open(o_file)
-        if (hdulist[0].header['IMAGETYP'] == 'Flat Field' or
-            hdulist[0].header['IMAGETYP'] == 'Light Frame'):
-            image_filters.add(hdulist[0].header['FILTER'])
-            hdulist.close()
+        hdr = read_header(o_file)
+        if (hdr['IMAGETYP'] == 'Flat Field' or
+                hdr['IMAGETYP'] == 'Light Frame'):
+            image_filters.add(hdr['FILTER'])
+        if hdr['IMAGETYP'] == 'Flat Field':
+            flat_paths[hdr['FILTER']].append(o_file)
 
     if len(image_filters) == 0:
         print('\nEither no light frame or flat field calibration files found. Ensure that they are saved in your target directory and try again.')
         sys.exit()
 
     for i in image_filters:
-        flat = False
-        flats = []
-        flat_prihdr = None
-        # Retrieves flats with the same filter name.
-        for o_file in files:
-            hdulist = fits.open(o_file)
-            if (hdulist[0].header['IMAGETYP'] == 'Flat Field' and
-                    hdulist[0].header['FILTER'] == i):
-                flat = True
-                flats.append(fits.getdata(o_file))
-                flat_prihdr = hdulist[0].header
-            hdulist.close()
-
-        if not flat:
+        if len(flat_paths[i]) == 0:
             print('\n{} flat field calibration files not found. Ensure that they are in your target directory and try again.'.format(i))
             sys.exit()
 
-        flat_array = np.array(flats, dtype=float)
+        # Reads the header that the master flat is saved with.
+        flat_prihdr = fits.getheader(flat_paths[i][-1])
 
-        # Removes bias from and normalizes each flat.
-        for flat in flat_array:
-            flat -= mbias_array[0]
-            flat /= np.average(flat[int(y_dim*0.2):int(y_dim*0.8), int(x_dim*0.2):int(x_dim*0.8)])
+        # Streams each flat with the same filter name into the stack,
+        # laid out as a per-pixel series, (y, x, n), like the bias and
+        # dark stacks.
+        flat_array = np.empty((y_dim, x_dim, len(flat_paths[i])),
+                              dtype=np.float32)
+        for n, o_file in enumerate(flat_paths[i]):
+            flat_array[..., n] = read_data(o_file)
 
-        mflat = np.average(flat_array, 0)
+        # Removes bias from and normalizes every flat in one vectorized
+        # pass over the stack instead of a Python loop per frame.
+        np.subtract(flat_array, mbias_array[0][..., np.newaxis],
+                    out=flat_array)
+        roi = flat_array[int(y_dim*0.2):int(y_dim*0.8),
+                         int(x_dim*0.2):int(x_dim*0.8), :]
+        flat_array /= roi.mean(axis=(0, 1))
+
+        mflat = flat_array.mean(axis=-1)
 
         # Saves master flat.
         hdu = fits.PrimaryHDU(mflat, header=flat_prihdr)
@@ -247,87 +653,107 @@ def instrument_signature_removal(dirtarget, target, image_filters):
     -------
     None
     """
+    # Scans every FITS file in dirtarget once, sorting light frame paths
+    # and exposure times by filter.
+    light_paths = defaultdict(list)
+    exptimes = {}
+    for path in sorted(os.listdir(dirtarget)):
+        if path.endswith('.fit'):
+            o_file = os.path.join(dirtarget, path)
+            hdr = read_header(o_file)
+            if hdr['IMAGETYP'] == 'Light Frame':
+                light_paths[hdr['FILTER']].append(o_file)
+                exptimes[hdr['FILTER']] = float(hdr['EXPTIME'])
+
+    # Gets mbias and mdark from mcalib once, since they do not depend on
+    # the filter, and notes the path of each master calibration file so
+    # the worker processes can load them themselves.
+    mbias_array = None
+    mbias_path = None
+    mdark_array = None
+    mdark_path = None
+    mflat_paths = {}
+    for path in sorted(os.listdir(os.path.join(dirtarget, 'mcalib'))):
+        if path.endswith('.fits'):
+            o_path = os.path.join(dirtarget, 'mcalib', path)
+            hdr = read_header(o_path)
+            if hdr['IMAGETYP'] == 'Bias Frame':
+                mbias_array = read_data(o_path)
+                mbias_path = o_path
+                # Get image dimensions from the header
+                x_dim = int(hdr['NAXIS1'])
+                y_dim = int(hdr['NAXIS2'])
+            if hdr['IMAGETYP'] == 'Dark Frame':
+                mdark_array = read_data(o_path)
+                mdark_path = o_path
+            if hdr['IMAGETYP'] == 'Flat Field':
+                mflat_paths[hdr['FILTER']] = o_path
+
+    # Generate list of strings of three-digit numbers from 0 to 999 used
+    # to name files that are written.
+    numbers1 = list(range(0, 999, 1))
+    numbers2 = []
+    for i in numbers1:
+        numbers2.append(str(i))
+    numbers = []
+    for i in numbers2:
+        if len(i) == 1:
+            numbers.append('00{}'.format(i))
+        if len(i) == 2:
+            numbers.append('0{}'.format(i))
+        if len(i) == 3:
+            numbers.append(i)
+
+    # The master bias and dark medians do not depend on the filter, so
+    # compute them once. Scaling the dark by a positive exposure time
+    # commutes with the median, so the full-image multiply per filter is
+    # replaced by a scalar one.
+    med_bias = np.median(mbias_array)
+    med_dark = np.median(mdark_array)
+
+    tasks = []
     for fil in image_filters:
-        mflat = []
-        mbias = []
-        mdark = []
-        exptime = None
-        # Gets mbias, mdark, and mflat of correct filter from mcalib.
-        for path in sorted(os.listdir(os.path.join(dirtarget, 'mcalib'))):
-            if path.endswith('.fits'):
-                o_path = os.path.join(dirtarget, 'mcalib', path)
-                calib_file = fits.open(o_path)
-                if calib_file[0].header['IMAGETYP'] == 'Bias Frame':
-                    mbias.append(calib_file[0].data)
-                    # Get image dimensions from the header
-                    x_dim = int(calib_file[0].header['NAXIS1'])
-                    y_dim = int(calib_file[0].header['NAXIS2'])
-                if calib_file[0].header['IMAGETYP'] == 'Dark Frame':
-                    mdark.append(calib_file[0].data)
-                if calib_file[0].header['IMAGETYP'] == 'Flat Field':
-                    if calib_file[0].header['FILTER'] == fil:
-                        mflat.append(calib_file[0].data)
-                calib_file.close()
-
-        for path in sorted(os.listdir(dirtarget)):
-            if path.endswith('.fit'):
-                print(path)
-                o_file = fits.open(os.path.join(dirtarget, path),
-                                   ignore_missing_end=True)
-                if o_file[0].header['IMAGETYP'] == 'Light Frame':
-                    if o_file[0].header['FILTER'] == fil:
-                        exptime = float(o_file[0].header['EXPTIME'])
-
-        mbias_array = np.array(mbias, dtype=float)[0]
-        mdark_array = np.array(mdark, dtype=float)[0]
-        mflat_array = np.array(mflat, dtype=float)[0]
+        exptime = exptimes[fil]
+        # Gets mflat of correct filter from mcalib.
+        mflat_array = read_data(mflat_paths[fil])
 
         # Calculates expected saturation of image.
         saturation = 65535
-        saturation -= np.median(mbias_array)
-        saturation -= np.median(mdark_array*exptime)
-        saturation /= np.average(mflat_array[int(y_dim*0.2):int(y_dim*0.8), int(x_dim*0.2):int(x_dim*0.8)])
+        saturation -= med_bias
+        saturation -= med_dark*exptime
+        saturation /= mflat_array[int(y_dim*0.2):int(y_dim*0.8), int(x_dim*0.2):int(x_dim*0.8)].mean()
         saturation *= 0.97
         saturation = int(saturation)
 
         # Makes directory for each filter to write ISR files to.
-        os.mkdir(os.path.join(dirtarget, 'ISR_Images', fil))
-
-        # Generate list of strings of three-digit numbers from 0 to 999 used
-        # to name files that are written.
-        numbers1 = list(range(0, 999, 1))
-        numbers2 = []
-        for i in numbers1:
-            numbers2.append(str(i))
-        numbers = []
-        for i in numbers2:
-            if len(i) == 1:
-                numbers.append('00{}'.format(i))
-            if len(i) == 2:
-                numbers.append('0{}'.format(i))
-            if len(i) == 3:
-                numbers.append(i)
-
-        # Finds all light frame images in dirtarget of correct filter.
-        for n, path in enumerate(sorted(os.listdir(dirtarget))):
-            if path.endswith(".fit"):
-                o_file = os.path.join(dirtarget, path)
-                hdulist = fits.open(o_file)
-                if (hdulist[0].header['IMAGETYP'] == 'Light Frame') and (hdulist[0].header['FILTER'] == fil):
-                    # Adds saturation to header.
-                    hdulist[0].header['SATLEVEL'] = saturation
-                    prihdr = hdulist[0].header
-                    image = hdulist[0].data
-                    image_array = np.array(image, dtype=float)
-
-                    # Removes instrument signatures.
-                    image_array -= mbias_array
-                    image_array -= (mdark_array*exptime)
-                    image_array /= mflat_array
-                    # Writes ISR file.
-                    hdu = fits.PrimaryHDU(image_array, header=prihdr)
-                    hdulist = fits.HDUList([hdu])
-                    out_path = os.path.join(dirtarget, 'ISR_Images', fil,
-                                            target + '_' + fil +
-                                            '_{}'.format(numbers[n+1]) + '.fits')
-                    hdulist.writeto(out_path, overwrite=True)
+        os.makedirs(os.path.join(dirtarget, 'ISR_Images', fil),
+                    exist_ok=True)
+
+        # Queues one task per light frame image of the correct filter.
+        for n, o_file in enumerate(light_paths[fil]):
+            out_path = os.path.join(dirtarget, 'ISR_Images', fil,
+                                    target + '_' + fil +
+                                    '_{}'.format(numbers[n+1]) + '.fits')
+            tasks.append((o_file, out_path, mbias_path, mdark_path,
+                          mflat_paths[fil], exptime, saturation))
+
+    # A worker records a failure in its final background write here,
+    # since the pool reports that frame's task as done. Clear any log
+    # left by an earlier run before processing starts.
+    error_log = os.path.join(dirtarget, 'ISR_Images', WRITE_ERROR_LOG)
+    if os.path.exists(error_log):
+        os.remove(error_log)
+
+    # Processes the light frames across all cores. Each frame only
+    # depends on the master calibration images, so the pool scales close
+    # to linearly with core count.
+    with ProcessPoolExecutor(max_workers=os.cpu_count(),
+                             initializer=_limit_worker_threads) as executor:
+        for name in executor.map(_isr_one_image, tasks):
+            print(name)
+
+    if os.path.exists(error_log):
+        with open(error_log) as log:
+            print(log.read(), file=sys.stderr)
+        print('\nOne or more ISR images could not be written. See the errors above and {}.'.format(error_log))
+        sys.exit()
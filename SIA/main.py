@@ -236,4 +236,9 @@ def which_analysis(interactive, answer, target, date, filters, coords,
                                               ann_out_rad, set_rad)
         print('\nPhotometry completed.')
 
-main()
+
+# The guard keeps multiprocessing start methods that re-import __main__
+# (spawn and forkserver) from re-running main() and its input() prompts
+# in every worker of the ISR process pool.
+if __name__ == '__main__':
+    main()